@@ -3,66 +3,231 @@ Fixed Email Agent - Compatible with Latest CrewAI Version
 Run this with: python agent.py
 """
 
-from dotenv import load_dotenv
-load_dotenv()
+import os
 
+# Set EMAIL_AGENT_SKIP_DOTENV=1 when the environment is already populated
+# (e.g. by a batch runner) to skip reading the .env file on import
+if os.getenv("EMAIL_AGENT_SKIP_DOTENV") != "1":
+    from dotenv import load_dotenv
+    load_dotenv()
+
+import asyncio
+import bisect
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import re
+import shelve
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from crewai import Agent, Task, Crew, Process
-from typing import Dict, Any
-from datetime import datetime
+from typing import Dict, Any, AsyncIterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import ahocorasick
+except ImportError:  # optional: falls back to one substring search per keyword
+    ahocorasick = None
 
 # ============================================
-# CUSTOM TOOLS (No decorator needed)
+# KEYWORD TABLES
 # ============================================
 
-def analyze_email_tool(email_content: str) -> Dict[str, Any]:
+# Keywords are matched as substrings of the lowercased email (so 'meeting' also
+# matches 'meetings'); multi-word phrases go through the same scan.
+URGENCY_KEYWORDS = frozenset({'urgent', 'asap', 'important', 'deadline', 'meeting', 'confirm', 
+                              'manager', 'client', 'tomorrow', 'today', 'emergency'})
+
+# Keywords that trigger a real-time notification
+ALERT_KEYWORDS = frozenset({'urgent', 'meeting', 'deadline', 'manager', 'client', 
+                            'tomorrow', 'today', 'asap', 'important', 'emergency'})
+
+SPAM_INDICATORS = frozenset({'lottery', 'winner', 'click here', 'free money', 'nigerian prince', 
+                             'congratulations you won', 'act now'})
+
+# Stronger indicators that put an email straight into the Spam category
+SPAM_CATEGORY_INDICATORS = frozenset({'lottery', 'winner', 'click here', 'free money'})
+
+WORK_KEYWORDS = frozenset({'meeting', 'project', 'deadline', 'manager', 'client', 'proposal', 
+                           'presentation', 'report', 'team', 'office', 'schedule'})
+
+PERSONAL_KEYWORDS = frozenset({'friend', 'family', 'weekend', 'party', 'dinner', 'birthday'})
+
+# Canned summary and reply used instead of the AI for Spam emails
+SPAM_SUMMARY = "Promotional/spam message; ignore."
+SPAM_REPLY = "No reply needed."
+
+# Reply tone for each classification
+TONE_GUIDE = {
+    "Work": "professional, respectful tone",
+    "Personal": "friendly and warm tone",
+    "Spam": "polite indication that no reply is needed",
+    "Other": "neutral, polite tone"
+}
+
+# Bit flags for each keyword table
+URGENT = 1
+ALERT = 2
+SPAM = 4
+SPAM_CATEGORY = 8
+WORK = 16
+PERSONAL = 32
+
+# Single keyword -> bitmask table so every keyword is searched only once
+KEYWORD_MASKS: Dict[str, int] = {}
+for _keywords, _flag in ((URGENCY_KEYWORDS, URGENT), (ALERT_KEYWORDS, ALERT),
+                         (SPAM_INDICATORS, SPAM), (SPAM_CATEGORY_INDICATORS, SPAM_CATEGORY),
+                         (WORK_KEYWORDS, WORK), (PERSONAL_KEYWORDS, PERSONAL)):
+    for _keyword in _keywords:
+        KEYWORD_MASKS[_keyword] = KEYWORD_MASKS.get(_keyword, 0) | _flag
+
+# Aho-Corasick automaton that finds every keyword in one pass over the text
+if ahocorasick is not None:
+    KEYWORD_AUTOMATON = ahocorasick.Automaton()
+    for _keyword, _mask in KEYWORD_MASKS.items():
+        KEYWORD_AUTOMATON.add_word(_keyword, (_keyword, _mask))
+    KEYWORD_AUTOMATON.make_automaton()
+else:
+    KEYWORD_AUTOMATON = None
+
+# Without Aho-Corasick, try a Numba-compiled Boyer-Moore-Horspool scan over the
+# UTF-8 bytes of the email. Keywords are ASCII, and ASCII bytes never occur inside
+# multi-byte UTF-8 sequences, so byte matches are exactly the substring matches.
+# numba is only imported when it will actually be used.
+njit = None
+if KEYWORD_AUTOMATON is None:
+    try:
+        import numpy as np
+        from numba import njit
+    except ImportError:  # optional: falls back to the pure-Python keyword scan
+        pass
+
+if njit is not None:
+    KEYWORD_LIST = list(KEYWORD_MASKS)
+    KEYWORD_BYTES = np.frombuffer(''.join(KEYWORD_LIST).encode('ascii'), dtype=np.uint8)
+    KEYWORD_OFFSETS = np.zeros(len(KEYWORD_LIST) + 1, dtype=np.int32)
+    KEYWORD_SHIFTS = np.zeros((len(KEYWORD_LIST), 256), dtype=np.int32)
+    for _i, _keyword in enumerate(KEYWORD_LIST):
+        KEYWORD_OFFSETS[_i + 1] = KEYWORD_OFFSETS[_i] + len(_keyword)
+        KEYWORD_SHIFTS[_i, :] = len(_keyword)
+        for _j, _char in enumerate(_keyword[:-1]):
+            KEYWORD_SHIFTS[_i, ord(_char)] = len(_keyword) - 1 - _j
+    
+    @njit(cache=True)
+    def _find_keywords(buf, kw_bytes, kw_offsets, kw_shifts):
+        """Return a 0/1 array marking which keywords occur in buf"""
+        found = np.zeros(kw_offsets.shape[0] - 1, dtype=np.uint8)
+        n = buf.shape[0]
+        for k in range(found.shape[0]):
+            start = kw_offsets[k]
+            m = kw_offsets[k + 1] - start
+            i = 0
+            while i <= n - m:
+                j = m - 1
+                while j >= 0 and buf[i + j] == kw_bytes[start + j]:
+                    j -= 1
+                if j < 0:
+                    found[k] = 1
+                    break
+                i += kw_shifts[k, buf[i + m - 1]]
+        return found
+
+
+def _extract_features(email_content: str) -> Dict[str, Any]:
     """
-    Analyzes email content to extract key information like urgency and spam indicators.
+    Scans the email once and collects every keyword-based feature.
     
     Args:
         email_content: The raw email text content
         
     Returns:
-        Dictionary with analyzed email components
+        Dictionary with urgency/spam flags and work/personal scores
     """
-    urgency_keywords = ['urgent', 'asap', 'important', 'deadline', 'meeting', 'confirm', 
-                       'manager', 'client', 'tomorrow', 'today', 'emergency']
+    email_lower = email_content.lower()
     
-    is_urgent = any(keyword in email_content.lower() for keyword in urgency_keywords)
+    # Distinct matched keywords (a repeated keyword only counts once)
+    if KEYWORD_AUTOMATON is not None:
+        matched = {keyword: mask for _, (keyword, mask) in KEYWORD_AUTOMATON.iter(email_lower)}
+    elif njit is not None:
+        buf = np.frombuffer(email_lower.encode('utf-8'), dtype=np.uint8)
+        found = _find_keywords(buf, KEYWORD_BYTES, KEYWORD_OFFSETS, KEYWORD_SHIFTS)
+        matched = {keyword: KEYWORD_MASKS[keyword] 
+                   for keyword, hit in zip(KEYWORD_LIST, found) if hit}
+    else:
+        matched = {keyword: mask for keyword, mask in KEYWORD_MASKS.items()
+                   if keyword in email_lower}
     
-    spam_indicators = ['lottery', 'winner', 'click here', 'free money', 'nigerian prince', 
-                      'congratulations you won', 'act now']
-    is_spam = any(indicator in email_content.lower() for indicator in spam_indicators)
+    flags = 0
+    work_score = 0
+    personal_score = 0
+    for mask in matched.values():
+        flags |= mask
+        work_score += bool(mask & WORK)
+        personal_score += bool(mask & PERSONAL)
     
     return {
-        'is_urgent': is_urgent,
-        'is_spam': is_spam,
+        'is_urgent': bool(flags & URGENT),
+        'needs_alert': bool(flags & ALERT),
+        'is_spam': bool(flags & SPAM),
+        'is_spam_category': bool(flags & SPAM_CATEGORY),
+        'work_score': work_score,
+        'personal_score': personal_score,
         'content_length': len(email_content)
     }
 
 
-def classify_email_tool(email_content: str) -> str:
+# ============================================
+# CUSTOM TOOLS (No decorator needed)
+# ============================================
+
+def analyze_email_tool(email_content: str, features: Dict[str, Any] = None) -> Dict[str, Any]:
+    """
+    Analyzes email content to extract key information like urgency and spam indicators.
+    
+    Args:
+        email_content: The raw email text content
+        features: Precomputed output of _extract_features (optional)
+        
+    Returns:
+        Dictionary with analyzed email components
+    """
+    if features is None:
+        features = _extract_features(email_content)
+    
+    return {
+        'is_urgent': features['is_urgent'],
+        'is_spam': features['is_spam'],
+        'content_length': features['content_length']
+    }
+
+
+def classify_email_tool(email_content: str, features: Dict[str, Any] = None) -> str:
     """
     Classifies email into categories: Work, Personal, Spam, or Other.
     
     Args:
         email_content: The email text
+        features: Precomputed output of _extract_features (optional)
         
     Returns:
         Classification category as string
     """
+    if features is None:
+        features = _extract_features(email_content)
+    
     # Check for spam first
-    spam_indicators = ['lottery', 'winner', 'click here', 'free money']
-    if any(indicator in email_content.lower() for indicator in spam_indicators):
+    if features['is_spam_category']:
         return "Spam"
     
-    work_keywords = ['meeting', 'project', 'deadline', 'manager', 'client', 'proposal', 
-                    'presentation', 'report', 'team', 'office', 'schedule']
-    personal_keywords = ['friend', 'family', 'weekend', 'party', 'dinner', 'birthday']
-    
-    email_lower = email_content.lower()
-    
-    work_score = sum(1 for keyword in work_keywords if keyword in email_lower)
-    personal_score = sum(1 for keyword in personal_keywords if keyword in email_lower)
+    work_score = features['work_score']
+    personal_score = features['personal_score']
     
     if work_score > personal_score:
         return "Work"
@@ -76,7 +241,7 @@ def classify_email_tool(email_content: str) -> str:
 # AGENTS
 # ============================================
 
-def create_email_analyzer_agent() -> Agent:
+def create_email_analyzer_agent(verbose: bool = False) -> Agent:
     """Creates an agent specialized in analyzing emails"""
     return Agent(
         role='Email Analyzer',
@@ -84,12 +249,12 @@ def create_email_analyzer_agent() -> Agent:
         backstory="""You are an expert at quickly reading and understanding emails. 
         You can identify important details, assess urgency, and detect spam or 
         unnecessary messages with high accuracy.""",
-        verbose=True,
+        verbose=verbose,
         allow_delegation=False
     )
 
 
-def create_email_classifier_agent() -> Agent:
+def create_email_classifier_agent(verbose: bool = False) -> Agent:
     """Creates an agent specialized in categorizing emails"""
     return Agent(
         role='Email Classifier',
@@ -97,24 +262,24 @@ def create_email_classifier_agent() -> Agent:
         backstory="""You are a master at categorizing emails based on their content, 
         context, and tone. You understand the nuances between professional and personal 
         communication.""",
-        verbose=True,
+        verbose=verbose,
         allow_delegation=False
     )
 
 
-def create_email_summarizer_agent() -> Agent:
+def create_email_summarizer_agent(verbose: bool = False) -> Agent:
     """Creates an agent specialized in summarizing emails"""
     return Agent(
         role='Email Summarizer',
         goal='Create clear and concise 2-3 sentence summaries of emails',
         backstory="""You are skilled at distilling complex information into brief, 
         clear summaries. You capture the essence of any message in just a few sentences.""",
-        verbose=True,
+        verbose=verbose,
         allow_delegation=False
     )
 
 
-def create_reply_writer_agent() -> Agent:
+def create_reply_writer_agent(verbose: bool = False) -> Agent:
     """Creates an agent specialized in drafting professional replies"""
     return Agent(
         role='Reply Writer',
@@ -122,7 +287,7 @@ def create_reply_writer_agent() -> Agent:
         backstory="""You are an expert communicator who writes polite, concise, and 
         professional email replies. You adapt your tone based on whether the email is 
         work-related or personal, always maintaining professionalism.""",
-        verbose=True,
+        verbose=verbose,
         allow_delegation=False
     )
 
@@ -131,67 +296,316 @@ def create_reply_writer_agent() -> Agent:
 # NOTIFICATION SYSTEM
 # ============================================
 
+SEPARATOR = "=" * 70
+
+
 class NotificationManager:
     """Manages console notifications"""
     
     def send_notification(self, message: str, title: str = "Email Alert"):
         """Send console notification"""
-        print("\n" + "="*70)
-        print(f"🔔 {title}")
-        print("="*70)
-        print(f"⏰ Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        print(f"📧 {message}")
-        print("="*70 + "\n")
+        # One write per notification instead of one print per line
+        sys.stdout.write(
+            f"\n{SEPARATOR}\n"
+            f"🔔 {title}\n"
+            f"{SEPARATOR}\n"
+            f"⏰ Time: {time.strftime('%Y-%m-%d %H:%M:%S')}\n"
+            f"📧 {message}\n"
+            f"{SEPARATOR}\n\n"
+        )
+        sys.stdout.flush()
 
 
 # ============================================
-# MAIN EMAIL ASSISTANT
+# RESPONSE CACHE
 # ============================================
 
-class EmailAssistant:
-    """Main class that orchestrates the email processing workflow"""
+class ResponseCache:
+    """Exact-match cache of AI summaries and replies, keyed by email content hash"""
     
-    def __init__(self):
-        self.analyzer_agent = create_email_analyzer_agent()
-        self.classifier_agent = create_email_classifier_agent()
-        self.summarizer_agent = create_email_summarizer_agent()
-        self.reply_agent = create_reply_writer_agent()
-        self.notifier = NotificationManager()
+    def __init__(self, maxsize: int = 1024, path: Optional[str] = None):
+        """
+        Args:
+            maxsize: Maximum number of in-memory entries (least recently used are evicted)
+            path: Optional shelve file to persist entries across runs
+        """
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+        self._store = shelve.open(path) if path else None
+        # shelve is not thread-safe, and the async helpers access it from worker threads
+        self._lock = threading.Lock()
     
-    def process_email(self, email_content: str) -> Dict[str, str]:
+    @staticmethod
+    def make_key(email_content: str, classification: str) -> str:
+        """Hash the email content and classification into a cache key"""
+        data = f"{classification}\0{email_content}".encode()
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+    
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """Return the cached (summary, reply) pair, or None on a miss"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            if self._store is not None and key in self._store:
+                entry = tuple(self._store[key])
+                self._remember(key, entry)
+                return entry
+            return None
+    
+    def set(self, key: str, summary: str, reply: str):
+        """Store a (summary, reply) pair"""
+        with self._lock:
+            self._remember(key, (summary, reply))
+            if self._store is not None:
+                self._store[key] = (summary, reply)
+                self._store.sync()
+    
+    async def get_async(self, key: str) -> Optional[Tuple[str, str]]:
+        """get() that reads the persistent store off the event loop"""
+        if self._store is None:
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+    
+    async def set_async(self, key: str, summary: str, reply: str):
+        """set() that writes and syncs the persistent store off the event loop"""
+        if self._store is None:
+            self.set(key, summary, reply)
+        else:
+            await asyncio.to_thread(self.set, key, summary, reply)
+    
+    def _remember(self, key: str, entry: Tuple[str, str]):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+    
+    def close(self):
+        """Close the persistent store, if any"""
+        with self._lock:
+            if self._store is not None:
+                self._store.close()
+                self._store = None
+
+
+# sentence-transformers config holding the model's max_seq_length
+SENTENCE_BERT_CONFIG = 'sentence_bert_config.json'
+
+# all-MiniLM-L6-v2's max_seq_length, used when the config file is missing
+DEFAULT_MAX_SEQ_LENGTH = 256
+
+
+def quantize_embedding_model(output_dir: str, 
+                             model_name: str = 'sentence-transformers/all-MiniLM-L6-v2'):
+    """
+    Export the semantic cache's embedding model to ONNX with dynamic int8 quantization.
+    
+    Args:
+        output_dir: Directory to write the quantized model and tokenizer to
+        model_name: Hugging Face model to export
+    """
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+    
+    model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+    quantizer = ORTQuantizer.from_pretrained(model)
+    quantizer.quantize(
+        save_dir=output_dir,
+        quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    )
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(output_dir)
+    
+    # Keep sentence-transformers' max_seq_length so embed() truncates the same way
+    from huggingface_hub import hf_hub_download
+    config_path = hf_hub_download(model_name, SENTENCE_BERT_CONFIG)
+    shutil.copy(config_path, os.path.join(output_dir, SENTENCE_BERT_CONFIG))
+
+
+class EmailResponseCache:
+    """
+    Semantic cache that reuses summaries and replies for near-duplicate emails.
+    
+    Emails are embedded with sentence-transformers (or an int8 ONNX export of the
+    same model) and looked up in a FAISS inner-product index (one per classification,
+    so Work and Personal hits never mix).
+    """
+    
+    def __init__(self, threshold: float = 0.92, model_name: str = 'all-MiniLM-L6-v2', 
+                 quantized_model_dir: Optional[str] = None, maxsize: int = 1024):
         """
-        Process an email through the complete workflow
-        
         Args:
-            email_content: The raw email text
-            
-        Returns:
-            Dictionary with summary, classification, reply, and notification
+            threshold: Minimum cosine similarity for a cache hit
+            model_name: sentence-transformers model used to embed emails
+            quantized_model_dir: Output of quantize_embedding_model; when set, emails are
+                embedded with the int8 ONNX model instead of the FP32 one
+            maxsize: Maximum number of cached emails per classification (oldest are evicted)
         """
-        print(f"\n⏳ Processing email at {datetime.now().strftime('%H:%M:%S')}...")
+        try:
+            import faiss
+            import numpy
+        except ImportError as e:
+            raise ImportError(
+                "Semantic caching requires: pip install sentence-transformers faiss-cpu"
+            ) from e
         
-        # STEP 1: Quick urgency check for real-time notification
-        if self._is_urgent(email_content):
-            subject = self._extract_subject(email_content)
-            self.notifier.send_notification(
-                message=f"Important email received: {subject}",
-                title="🚨 URGENT EMAIL ALERT"
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self._faiss = faiss
+        self._numpy = numpy
+        self.model = None
+        self.onnx_model = None
+        
+        if quantized_model_dir:
+            try:
+                from optimum.onnxruntime import ORTModelForFeatureExtraction
+                from transformers import AutoTokenizer
+            except ImportError as e:
+                raise ImportError(
+                    "Quantized embeddings require: pip install optimum[onnxruntime]"
+                ) from e
+            self.tokenizer = AutoTokenizer.from_pretrained(quantized_model_dir)
+            # The tokenizer's model_max_length (512) is longer than what
+            # sentence-transformers embeds, so truncate to max_seq_length instead
+            self.max_seq_length = DEFAULT_MAX_SEQ_LENGTH
+            config_path = os.path.join(quantized_model_dir, SENTENCE_BERT_CONFIG)
+            if os.path.exists(config_path):
+                with open(config_path) as f:
+                    self.max_seq_length = json.load(f).get('max_seq_length', DEFAULT_MAX_SEQ_LENGTH)
+            self.onnx_model = ORTModelForFeatureExtraction.from_pretrained(
+                quantized_model_dir, file_name="model_quantized.onnx"
             )
+        else:
+            try:
+                from sentence_transformers import SentenceTransformer
+            except ImportError as e:
+                raise ImportError(
+                    "Semantic caching requires: pip install sentence-transformers faiss-cpu"
+                ) from e
+            self.model = SentenceTransformer(model_name)
         
-        # STEP 2: Analyze email
-        print("\n📊 Step 1: Analyzing email...")
-        analysis_result = analyze_email_tool(email_content)
-        print(f"   ✅ Analysis complete: {analysis_result}")
+        # Tokenizers and model inference are not safe to share between threads, and
+        # callers run embed() in worker threads, so embeddings are computed one at a time
+        self._embed_lock = threading.Lock()
         
-        # STEP 3: Classify email
-        print("\n📂 Step 2: Classifying email...")
-        classification = classify_email_tool(email_content)
-        print(f"   ✅ Classification: {classification}")
+        # Per classification: FAISS index with explicit ids, id -> (summary, reply),
+        # and ids in insertion order for FIFO eviction
+        self._indexes: Dict[str, Any] = {}
+        self._responses: Dict[str, Dict[int, Tuple[str, str]]] = {}
+        self._insertion_order: Dict[str, deque] = {}
+        self._next_id = 0
+    
+    def embed(self, email_content: str):
+        """Embed an email as a normalized float32 row vector"""
+        with self._embed_lock:
+            return self._embed(email_content)
+    
+    def _embed(self, email_content: str):
+        if self.onnx_model is None:
+            return self.model.encode([email_content], normalize_embeddings=True).astype('float32')
         
-        # STEP 4: Summarize email using AI
-        print("\n📝 Step 3: Generating summary...")
+        # Mean-pool the token embeddings, as sentence-transformers does for this model
+        inputs = self.tokenizer([email_content], padding=True, truncation=True, 
+                                max_length=self.max_seq_length, return_tensors='np')
+        hidden = self.onnx_model(**inputs).last_hidden_state
+        mask = inputs['attention_mask'][..., None]
+        pooled = (hidden * mask).sum(axis=1) / self._numpy.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= self._numpy.linalg.norm(pooled, axis=1, keepdims=True)
+        return pooled.astype('float32')
+    
+    def lookup(self, email_content: str, classification: str, 
+               embedding=None) -> Optional[Tuple[str, str]]:
+        """Return the (summary, reply) of the most similar cached email, or None"""
+        index = self._indexes.get(classification)
+        if index is None or index.ntotal == 0:
+            return None
+        if embedding is None:
+            embedding = self.embed(email_content)
+        scores, ids = index.search(embedding, 1)
+        if scores[0][0] >= self.threshold:
+            return self._responses[classification][int(ids[0][0])]
+        return None
+    
+    def update(self, email_content: str, classification: str, summary: str, reply: str, 
+               embedding=None):
+        """Add an email and its generated summary and reply to the cache"""
+        if embedding is None:
+            embedding = self.embed(email_content)
+        index = self._indexes.get(classification)
+        if index is None:
+            index = self._faiss.IndexIDMap(self._faiss.IndexFlatIP(embedding.shape[1]))
+            self._indexes[classification] = index
+            self._responses[classification] = {}
+            self._insertion_order[classification] = deque()
+        
+        entry_id = self._next_id
+        self._next_id += 1
+        index.add_with_ids(embedding, self._numpy.array([entry_id], dtype='int64'))
+        self._responses[classification][entry_id] = (summary, reply)
+        
+        order = self._insertion_order[classification]
+        order.append(entry_id)
+        if len(order) > self.maxsize:
+            oldest = order.popleft()
+            index.remove_ids(self._numpy.array([oldest], dtype='int64'))
+            del self._responses[classification][oldest]
+
+
+# ============================================
+# MAIN EMAIL ASSISTANT
+# ============================================
+
+def _bucket_by_length(emails: List[str], length_buckets: Tuple[int, ...]) -> List[List[int]]:
+    """Group email positions by approximate token count (~4 characters per token)"""
+    length_buckets = sorted(length_buckets)
+    buckets: List[List[int]] = [[] for _ in range(len(length_buckets) + 1)]
+    for i, email_content in enumerate(emails):
+        buckets[bisect.bisect_right(length_buckets, len(email_content) // 4)].append(i)
+    return [positions for positions in buckets if positions]
+
+
+# Thread pool that runs Crew kickoffs for the current batch. asyncio's default
+# pool is capped at min(32, cpu_count + 4) threads and shared with other
+# to_thread calls, which would silently cap max_inflight below what was asked.
+_KICKOFF_EXECUTOR: "contextvars.ContextVar[Optional[ThreadPoolExecutor]]" = \
+    contextvars.ContextVar('_KICKOFF_EXECUTOR', default=None)
+
+
+# Used to find the first line of an email without stripping or splitting all of it
+_LEADING_WHITESPACE = re.compile(r'\s*')
+_TRAILING_WHITESPACE = re.compile(r'\s*\Z')
+
+
+class EmailAssistant:
+    """Main class that orchestrates the email processing workflow"""
+    
+    def __init__(self, cache_path: Optional[str] = None, semantic_cache: bool = False, 
+                 skip_llm_for_spam: bool = True, quantized_model_dir: Optional[str] = None, 
+                 verbose: bool = False):
+        """
+        Args:
+            cache_path: Optional file to persist cached summaries and replies across runs
+            semantic_cache: Also reuse replies for near-duplicate emails (needs 
+                sentence-transformers and faiss-cpu)
+            skip_llm_for_spam: Use a canned summary and reply for Spam instead of calling the AI
+            quantized_model_dir: int8 embedding model for the semantic cache 
+                (see quantize_embedding_model)
+            verbose: Let the CrewAI agents and Crews print their own progress
+        """
+        self.analyzer_agent = create_email_analyzer_agent(verbose)
+        self.classifier_agent = create_email_classifier_agent(verbose)
+        self.summarizer_agent = create_email_summarizer_agent(verbose)
+        self.reply_agent = create_reply_writer_agent(verbose)
+        self.notifier = NotificationManager()
+        self.skip_llm_for_spam = skip_llm_for_spam
+        self.cache = ResponseCache(path=cache_path)
+        self.semantic_cache = (EmailResponseCache(quantized_model_dir=quantized_model_dir) 
+                               if semantic_cache else None)
+        
+        # Crews are built once; each email is passed in through kickoff inputs so the
+        # agent roles and prompts stay token-identical across calls (provider prompt caching)
         summary_task = Task(
-            description=f"""Summarize the following email in 2-3 clear, concise sentences.
+            description="""Summarize the following email in 2-3 clear, concise sentences.
             
             Email Content:
             {email_content}
@@ -200,29 +614,15 @@ class EmailAssistant:
             expected_output="A 2-3 sentence summary of the email",
             agent=self.summarizer_agent
         )
-        
-        summary_crew = Crew(
+        self.summary_crew = Crew(
             agents=[self.summarizer_agent],
             tasks=[summary_task],
             process=Process.sequential,
-            verbose=False
+            verbose=verbose
         )
         
-        summary = str(summary_crew.kickoff()).strip()
-        print(f"   ✅ Summary generated")
-        
-        # STEP 5: Draft reply using AI
-        print("\n✍️  Step 4: Drafting reply...")
-        
-        tone_guide = {
-            "Work": "professional, respectful tone",
-            "Personal": "friendly and warm tone",
-            "Spam": "polite indication that no reply is needed",
-            "Other": "neutral, polite tone"
-        }
-        
         reply_task = Task(
-            description=f"""Draft a professional reply to the following email.
+            description="""Draft a professional reply to the following email.
             
             Email Content:
             {email_content}
@@ -230,26 +630,208 @@ class EmailAssistant:
             Classification: {classification}
             
             Guidelines:
-            - Use {tone_guide.get(classification, 'professional tone')}
+            - Use {tone}
             - Keep it concise and contextually appropriate
             - Address any requests or questions in the email
             - If spam, simply state no reply is needed""",
             expected_output="A professional, well-formatted email reply",
             agent=self.reply_agent
         )
-        
-        reply_crew = Crew(
+        self.reply_crew = Crew(
             agents=[self.reply_agent],
             tasks=[reply_task],
             process=Process.sequential,
-            verbose=False
+            verbose=verbose
         )
         
-        reply = str(reply_crew.kickoff()).strip()
-        print(f"   ✅ Reply drafted")
+        # Idle copies of the Crews above, reused across emails (see _kickoff_pooled)
+        self._idle_crews: Dict[int, List[Crew]] = defaultdict(list)
+    
+    def process_email(self, email_content: str) -> Dict[str, str]:
+        """
+        Process an email through the complete workflow
+        
+        Args:
+            email_content: The raw email text
+            
+        Returns:
+            Dictionary with summary, classification, reply, and notification
+        """
+        return asyncio.run(self.process_email_async(email_content))
+    
+    async def process_emails(self, emails: List[str], max_inflight: int = 16, 
+                             length_buckets: Tuple[int, ...] = (256, 512, 1024)) -> List[Any]:
+        """
+        Process a batch of emails concurrently
+        
+        Duplicate emails are only processed once. All emails are submitted at once; 
+        length_buckets only sets a shortest-first dispatch order. Each email is a 
+        separate request, so this is a scheduling hint, not a padding saving.
+        
+        Args:
+            emails: List of raw email texts
+            max_inflight: Maximum number of emails being processed at the same time
+            length_buckets: Token-count boundaries between length groups, in any order 
+                (empty to keep input order)
+            
+        Returns:
+            One result dictionary per email, in input order (or the exception 
+            raised while processing that email)
+        """
+        # Identical emails are processed once and the result is copied to every position
+        duplicate_positions: Dict[str, List[int]] = defaultdict(list)
+        for i, email_content in enumerate(emails):
+            duplicate_positions[email_content].append(i)
+        unique_emails = list(duplicate_positions)
+        
+        # The semaphore admits waiters in order, so this is also the dispatch order
+        order = [i for positions in _bucket_by_length(unique_emails, length_buckets) 
+                 for i in positions]
         
-        # STEP 6: Generate notification text
-        notification = self._generate_notification(email_content)
+        semaphore, executor = self._start_batch(max_inflight)
+        # Tasks copy the context when created, so the executor only needs to be set here
+        token = _KICKOFF_EXECUTOR.set(executor)
+        try:
+            batch = asyncio.gather(
+                *(self._process_bounded(unique_emails[i], semaphore) for i in order), 
+                return_exceptions=True
+            )
+        finally:
+            _KICKOFF_EXECUTOR.reset(token)
+        try:
+            unique_results = await batch
+        finally:
+            executor.shutdown(wait=False)
+        
+        results: List[Any] = [None] * len(emails)
+        for i, result in zip(order, unique_results):
+            for position in duplicate_positions[unique_emails[i]]:
+                results[position] = dict(result) if isinstance(result, dict) else result
+        return results
+    
+    async def stream_process(self, emails: List[str], max_inflight: int = 16, 
+                             preserve_order: bool = False) -> AsyncIterator[Tuple[int, Any]]:
+        """
+        Process a batch of emails concurrently, yielding each result as soon as it is ready
+        
+        Args:
+            emails: List of raw email texts
+            max_inflight: Maximum number of emails being processed at the same time
+            preserve_order: Yield results in input order (waits for the whole batch)
+            
+        Yields:
+            (index, result) pairs, where index is the email's position in emails and 
+            result is its result dictionary (or the exception raised while processing it)
+        """
+        semaphore, executor = self._start_batch(max_inflight)
+        
+        async def process_indexed(index: int, email_content: str) -> Tuple[int, Any]:
+            try:
+                return index, await self._process_bounded(email_content, semaphore)
+            except Exception as e:
+                return index, e
+        
+        token = _KICKOFF_EXECUTOR.set(executor)
+        try:
+            tasks = [asyncio.ensure_future(process_indexed(i, email)) 
+                     for i, email in enumerate(emails)]
+        finally:
+            _KICKOFF_EXECUTOR.reset(token)
+        try:
+            if preserve_order:
+                for item in await asyncio.gather(*tasks):
+                    yield item
+            else:
+                for next_done in asyncio.as_completed(tasks):
+                    yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+            executor.shutdown(wait=False)
+    
+    def _start_batch(self, max_inflight: int) -> Tuple[asyncio.Semaphore, ThreadPoolExecutor]:
+        """Create the semaphore and kickoff thread pool for a batch of max_inflight emails"""
+        if max_inflight < 1:
+            raise ValueError(f"max_inflight must be at least 1, got {max_inflight}")
+        # Each email in flight runs two Crew kickoffs at once (summary and reply)
+        executor = ThreadPoolExecutor(max_workers=2 * max_inflight, 
+                                      thread_name_prefix='email-agent-kickoff')
+        return asyncio.Semaphore(max_inflight), executor
+    
+    async def _process_bounded(self, email_content: str, 
+                               semaphore: asyncio.Semaphore) -> Dict[str, str]:
+        """Process one email while holding a slot of the batch semaphore"""
+        async with semaphore:
+            return await self.process_email_async(email_content)
+    
+    async def process_email_async(self, email_content: str) -> Dict[str, str]:
+        """
+        Async version of process_email. The summary and reply Crews only
+        depend on the locally computed classification, so they run concurrently.
+        
+        Args:
+            email_content: The raw email text
+            
+        Returns:
+            Dictionary with summary, classification, reply, and notification
+        """
+        # The timestamp comes from the log format (%(asctime)s), so nothing is formatted
+        # here when DEBUG logging is off
+        logger.debug("⏳ Processing email...")
+        
+        # Scan the email once; every check below reads from these features
+        features = _extract_features(email_content)
+        
+        # STEP 1: Quick urgency check for real-time notification
+        if self._is_urgent(email_content, features):
+            subject = self._extract_subject(email_content)
+            self.notifier.send_notification(
+                message=f"Important email received: {subject}",
+                title="🚨 URGENT EMAIL ALERT"
+            )
+        
+        # STEP 2: Analyze email
+        logger.debug("📊 Step 1: Analyzing email...")
+        analysis_result = analyze_email_tool(email_content, features)
+        logger.debug("   ✅ Analysis complete: %s", analysis_result)
+        
+        # STEP 3: Classify email
+        logger.debug("📂 Step 2: Classifying email...")
+        classification = classify_email_tool(email_content, features)
+        logger.debug("   ✅ Classification: %s", classification)
+        
+        # Spam needs no AI summary or reply
+        if classification == "Spam" and self.skip_llm_for_spam:
+            logger.debug("🚫 Steps 3-4: Spam detected, skipping AI summary and reply")
+            return {
+                'summary': SPAM_SUMMARY,
+                'classification': classification,
+                'reply': SPAM_REPLY,
+                'notification': self._generate_notification(email_content, features)
+            }
+        
+        # STEP 4: Summarize email and draft reply using AI (skipped for repeated emails)
+        cache_key = ResponseCache.make_key(email_content, classification)
+        cached = await self.cache.get_async(cache_key)
+        embedding = None
+        if cached is None and self.semantic_cache is not None:
+            # Embedding runs the model; keep it off the event loop so batches stay concurrent
+            embedding = await asyncio.to_thread(self.semantic_cache.embed, email_content)
+            cached = self.semantic_cache.lookup(email_content, classification, embedding)
+            if cached is not None:
+                await self.cache.set_async(cache_key, *cached)
+        
+        if cached is not None:
+            logger.debug("♻️  Steps 3-4: Reusing cached summary and reply")
+            summary, reply = cached
+        else:
+            summary, reply = await self._generate_summary_and_reply(email_content, classification)
+            await self.cache.set_async(cache_key, summary, reply)
+            if self.semantic_cache is not None:
+                self.semantic_cache.update(email_content, classification, summary, reply, embedding)
+        
+        # STEP 5: Generate notification text
+        notification = self._generate_notification(email_content, features)
         
         return {
             'summary': summary,
@@ -258,25 +840,85 @@ class EmailAssistant:
             'notification': notification
         }
     
-    def _is_urgent(self, email_content: str) -> bool:
+    async def _generate_summary_and_reply(self, email_content: str, 
+                                          classification: str) -> Tuple[str, str]:
+        """Run the summary and reply Crews concurrently"""
+        logger.debug("📝 Step 3: Generating summary...")
+        logger.debug("✍️  Step 4: Drafting reply...")
+        
+        summary_output, reply_output = await asyncio.gather(
+            self._kickoff_pooled(self.summary_crew, {'email_content': email_content}),
+            self._kickoff_pooled(self.reply_crew, {
+                'email_content': email_content,
+                'classification': classification,
+                'tone': TONE_GUIDE.get(classification, 'professional tone')
+            })
+        )
+        summary = str(summary_output).strip()
+        logger.debug("   ✅ Summary generated")
+        reply = str(reply_output).strip()
+        logger.debug("   ✅ Reply drafted")
+        return summary, reply
+    
+    async def _kickoff_pooled(self, crew: Crew, inputs: Dict[str, str]) -> Any:
+        """
+        Kick off an idle copy of a shared Crew.
+        
+        Concurrent emails must never interpolate inputs into the same Task, so each
+        kickoff gets its own copy (as kickoff_for_each_async does). Copies are returned
+        to the pool afterwards and reused, instead of rebuilding one for every email.
+        """
+        idle = self._idle_crews[id(crew)]
+        crew_copy = idle.pop() if idle else crew.copy()
+        executor = _KICKOFF_EXECUTOR.get()
+        if executor is None:
+            output = await crew_copy.kickoff_async(inputs=inputs)
+        else:
+            # Same as kickoff_async, but on the batch's own thread pool
+            loop = asyncio.get_running_loop()
+            output = await loop.run_in_executor(executor, 
+                                                functools.partial(crew_copy.kickoff, inputs=inputs))
+        idle.append(crew_copy)
+        return output
+    
+    def reset_crew_pool(self):
+        """Drop pooled Crew copies (call after reconfiguring the agents or Crews)"""
+        self._idle_crews.clear()
+    
+    def _is_urgent(self, email_content: str, features: Dict[str, Any] = None) -> bool:
         """Quick urgency check for real-time alerts"""
-        urgent_keywords = ['urgent', 'meeting', 'deadline', 'manager', 'client', 
-                          'tomorrow', 'today', 'asap', 'important', 'emergency']
-        return any(keyword in email_content.lower() for keyword in urgent_keywords)
+        if features is None:
+            features = _extract_features(email_content)
+        return features['needs_alert']
     
     def _extract_subject(self, email_content: str) -> str:
         """Extract subject or first line from email"""
-        lines = email_content.strip().split('\n')
-        subject = lines[0] if lines else "New Email"
+        # Only scan up to the end of the first non-blank line
+        start = _LEADING_WHITESPACE.match(email_content).end()
+        end = email_content.find('\n', start)
+        if end == -1 or _TRAILING_WHITESPACE.match(email_content, end):
+            subject = email_content[start:].rstrip()
+        else:
+            subject = email_content[start:end]
         return subject[:60] + "..." if len(subject) > 60 else subject
     
-    def _generate_notification(self, email_content: str) -> str:
+    def _generate_notification(self, email_content: str, features: Dict[str, Any] = None) -> str:
         """Generate notification text for output"""
-        if self._is_urgent(email_content):
+        if self._is_urgent(email_content, features):
             subject = self._extract_subject(email_content)
             return f"🚨 IMPORTANT EMAIL ALERT: {subject}"
         return "None"
     
+    def close(self):
+        """Close the persistent response cache, if any"""
+        self.cache.close()
+    
+    def __enter__(self) -> "EmailAssistant":
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
     def format_output(self, result: Dict[str, str]) -> str:
         """Format the final output in the specified structure"""
         return f"""Summary: {result['summary']}
@@ -290,16 +932,17 @@ Notification: {result['notification']}"""
 # ============================================
 
 if __name__ == "__main__":
-    print("="*70)
-    print("EMAIL AGENT - SMART EMAIL ASSISTANT")
-    print("="*70)
+    # Show the per-step progress messages
+    logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%H:%M:%S")
+    logger.setLevel(logging.DEBUG)
+    
+    print(f"{SEPARATOR}\nEMAIL AGENT - SMART EMAIL ASSISTANT\n{SEPARATOR}")
     
     # Initialize the Email Assistant
     assistant = EmailAssistant()
     
     # Example 1: Urgent work email
-    print("\n📧 EXAMPLE 1: Urgent Work Email")
-    print("-"*70)
+    print("\n📧 EXAMPLE 1: Urgent Work Email\n" + "-"*70)
     
     example_email_1 = """Email:  
 Hello Laxmana,  
@@ -310,15 +953,11 @@ Project Manager"""
     
     result1 = assistant.process_email(example_email_1)
     
-    print("\n" + "="*70)
-    print("📋 RESULT")
-    print("="*70)
-    print(assistant.format_output(result1))
-    print("="*70)
+    print(f"\n{SEPARATOR}\n📋 RESULT\n{SEPARATOR}\n"
+          f"{assistant.format_output(result1)}\n{SEPARATOR}")
     
     # Example 2: Personal email
-    print("\n\n📧 EXAMPLE 2: Personal Email")
-    print("-"*70)
+    print("\n\n📧 EXAMPLE 2: Personal Email\n" + "-"*70)
     
     example_email_2 = """Email:
 Hey Laxmana!
@@ -329,15 +968,11 @@ Raj"""
     
     result2 = assistant.process_email(example_email_2)
     
-    print("\n" + "="*70)
-    print("📋 RESULT")
-    print("="*70)
-    print(assistant.format_output(result2))
-    print("="*70)
+    print(f"\n{SEPARATOR}\n📋 RESULT\n{SEPARATOR}\n"
+          f"{assistant.format_output(result2)}\n{SEPARATOR}")
     
     # Example 3: Spam email
-    print("\n\n📧 EXAMPLE 3: Spam Email")
-    print("-"*70)
+    print("\n\n📧 EXAMPLE 3: Spam Email\n" + "-"*70)
     
     example_email_3 = """Email:
 CONGRATULATIONS! You've won the lottery!
@@ -346,11 +981,8 @@ Act now, limited time offer!"""
     
     result3 = assistant.process_email(example_email_3)
     
-    print("\n" + "="*70)
-    print("📋 RESULT")
-    print("="*70)
-    print(assistant.format_output(result3))
-    print("="*70)
+    print(f"\n{SEPARATOR}\n📋 RESULT\n{SEPARATOR}\n"
+          f"{assistant.format_output(result3)}\n{SEPARATOR}")
     
     print("\n✅ All examples completed!")
     print("\n💡 To process your own emails, modify the email content and run again."